@@ -0,0 +1,80 @@
+"""
+Замер поиска ближайшего цвета палитры (lab_1, PaletteIndex).
+
+Примеры:
+    python bench_palette.py
+    python bench_palette.py --palette-size 1000000 --queries 1000000 --check 2000
+
+Запросы - случайные цвета со всего куба RGB, поэтому у палитр-подмножеств (поддиапазон,
+скопление, два скопления, плоскость) большинство запросов лежит вне рамки палитры: это
+худший случай для отсечения по рамкам. Для каждой палитры печатается время построения
+индекса и запроса, а ответ на --check запросах сверяется с полным перебором
+(время перебора пересчитывается на все запросы для сравнения).
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+from lab_1.app import PaletteIndex, palette_coordinates, _nearest_brute
+
+
+def palettes(rng, size):
+    half = size // 2
+    return {
+        "uniform": rng.integers(0, 256, (size, 3)),
+        "subcube 0..63": rng.integers(0, 64, (size, 3)),
+        "cluster sd=2": rng.normal(128, 2, (size, 3)),
+        "two clusters": np.concatenate([rng.normal(30, 3, (half, 3)), rng.normal(220, 3, (size - half, 3))]),
+        "plane b=7": np.stack([rng.integers(0, 256, size), rng.integers(0, 256, size), np.full(size, 7)], axis=1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the lab_1 palette index")
+    parser.add_argument("--palette-size", type=int, default=50_000)
+    parser.add_argument("--queries", type=int, default=100_000)
+    parser.add_argument("--check", type=int, default=1000, help="queries verified against brute force")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    queries = rng.integers(0, 256, (args.queries, 3)).astype(np.uint8)
+    checked = queries[:args.check]
+
+    print(f"palette {args.palette_size}, queries {args.queries}, verified {len(checked)}")
+    failed = False
+    for space in ("rgb", "hls"):
+        for name, palette in palettes(rng, args.palette_size).items():
+            palette = np.clip(np.rint(palette), 0, 255).astype(np.uint8)
+
+            start = time.perf_counter()
+            index = PaletteIndex(palette, space)
+            build = time.perf_counter() - start
+
+            start = time.perf_counter()
+            index.query(queries)
+            query = time.perf_counter() - start
+
+            # Выборка сверяется с перебором, время перебора - на все запросы
+            found, distances = index.query(checked)
+            start = time.perf_counter()
+            expected, expected_d2 = _nearest_brute(palette_coordinates(checked, space), index.points)
+            brute = (time.perf_counter() - start) * args.queries / max(len(checked), 1)
+            exact = np.allclose(distances, np.sqrt(expected_d2)) and np.array_equal(found, expected)
+            failed |= not exact
+
+            print(f"{space} {name:14s} build {build:6.2f}s  query {query:7.2f}s  "
+                  f"brute ~{brute:8.2f}s  {'exact' if exact else 'MISMATCH'}")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+"""
+Общий слой метрик для всех лабораторных.
+
+Подключение в приложении:
+    setup_metrics(app, "lab_2")
+
+Что собирается (формат Prometheus, эндпоинт /metrics):
+    http_request_duration_seconds - время запроса по маршруту, методу, статусу, алгоритму и размеру изображения
+    http_request_size_bytes / http_response_size_bytes - размеры тела запроса и ответа
+    stage_duration_seconds - время этапов внутри обработчика (parse, compute, encode, ...)
+    slow_requests_total - запросы дольше порога профилировщика
+
+Метки алгоритма и размера изображения обработчик задаёт сам через set_labels(),
+этапы размечаются блоком `with stage("compute"): ...`. Значения, пришедшие от клиента,
+сначала проходят через known_label(), иначе каждое новое значение создаёт новую серию.
+
+Профилировщик медленных запросов включается переменной окружения LAB_PROFILE_SLOW_MS:
+пока идут запросы, фоновый поток раз в LAB_PROFILE_INTERVAL_MS снимает стеки потоков,
+выполняющих код приложения, и для запроса дольше порога в лог пишутся самые частые стеки.
+"""
+import contextvars
+import logging
+import os
+import queue
+import selectors
+import sys
+import sysconfig
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from starlette.routing import Match
+from starlette.responses import Response
+
+logger = logging.getLogger("instrumentation")
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000)
+
+# Метки текущего запроса: маршрут задаёт middleware, остальное - обработчик
+_request_labels = contextvars.ContextVar("request_labels", default=None)
+
+
+class Histogram:
+    """Гистограмма с накопительными корзинами, отдельная для каждого набора меток"""
+
+    def __init__(self, name, description, label_names, buckets):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+                    break
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            items = [(key, list(s["counts"]), s["sum"], s["count"]) for key, s in sorted(self.series.items())]
+        for key, counts, total, count in items:
+            labels = _format_labels(self.label_names, key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return lines
+
+
+class CounterMetric:
+    """Счётчик по наборам меток"""
+
+    def __init__(self, name, description, label_names):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.series = Counter()
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self.lock:
+            self.series[key] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            items = sorted(self.series.items())
+        for key, value in items:
+            lines.append(f"{self.name}{{{_format_labels(self.label_names, key)}}} {value}")
+        return lines
+
+
+def _format_labels(names, values):
+    escaped = (v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return ",".join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+
+REQUEST_LABELS = ("app", "route", "method", "status", "algorithm", "image_size")
+STAGE_LABELS = ("app", "route", "stage", "algorithm", "image_size")
+
+REQUEST_DURATION = Histogram("http_request_duration_seconds", "HTTP request latency in seconds",
+                             REQUEST_LABELS, LATENCY_BUCKETS)
+REQUEST_SIZE = Histogram("http_request_size_bytes", "HTTP request body size in bytes",
+                         ("app", "route", "method"), SIZE_BUCKETS)
+RESPONSE_SIZE = Histogram("http_response_size_bytes", "HTTP response body size in bytes",
+                          ("app", "route", "method"), SIZE_BUCKETS)
+STAGE_DURATION = Histogram("stage_duration_seconds", "Duration of processing stages in seconds",
+                           STAGE_LABELS, LATENCY_BUCKETS)
+SLOW_REQUESTS = CounterMetric("slow_requests_total", "Requests slower than the profiler threshold",
+                              ("app", "route", "method"))
+
+METRICS = (REQUEST_DURATION, REQUEST_SIZE, RESPONSE_SIZE, STAGE_DURATION, SLOW_REQUESTS)
+
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def image_size_label(img):
+    """Размер изображения корзиной по мегапикселям, чтобы не плодить значения метки"""
+    if img is None:
+        return ""
+    pixels = img.shape[0] * img.shape[1]
+    for limit, label in ((250_000, "<=0.25MP"), (1_000_000, "<=1MP"), (4_000_000, "<=4MP"), (16_000_000, "<=16MP")):
+        if pixels <= limit:
+            return label
+    return ">16MP"
+
+
+def known_label(value, allowed):
+    """Значение метки из закрытого набора, всё остальное - other"""
+    return value if value in allowed else "other"
+
+
+def set_labels(**labels):
+    """Задаёт метки алгоритма и размера изображения для текущего запроса"""
+    current = _request_labels.get()
+    if current is not None:
+        current.update({k: str(v) for k, v in labels.items()})
+
+
+@contextmanager
+def stage(name):
+    """Замер этапа обработки: with stage("parse"): ..."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        labels = _request_labels.get() or {}
+        STAGE_DURATION.observe(time.perf_counter() - start, stage=name,
+                               **{k: v for k, v in labels.items() if k in STAGE_LABELS and k != "stage"})
+
+
+@contextmanager
+def request_labels(app_name, route):
+    """Метки для кода вне HTTP-запроса (например, кадры WebSocket)"""
+    token = _request_labels.set({"app": app_name, "route": route, "algorithm": "", "image_size": ""})
+    try:
+        yield
+    finally:
+        _request_labels.reset(token)
+
+
+# Поток, остановленный в этих модулях, ждёт работу (очередь пула, select цикла событий)
+IDLE_FILES = frozenset(module.__file__ for module in (threading, queue, selectors))
+# Стандартная библиотека и установленные пакеты (в том числе служебные маршруты FastAPI)
+LIBRARY_DIRS = tuple({sysconfig.get_paths()[name] for name in ("stdlib", "platstdlib", "purelib", "platlib")})
+
+
+class SamplingProfiler:
+    """Фоновый поток, снимающий стеки потоков с кодом приложения, пока есть активные запросы"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        # Каталоги с обработчиками приложения, заполняет MetricsMiddleware
+        self.code_dirs = set()
+        self.lock = threading.Lock()
+        self.active = {}
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self.thread.start()
+
+    def start(self, request_id):
+        with self.lock:
+            self.active[request_id] = Counter()
+        self.wakeup.set()
+
+    def stop(self, request_id):
+        with self.lock:
+            return self.active.pop(request_id, Counter())
+
+    def _is_app_code(self, filename):
+        return filename != __file__ and os.path.dirname(filename) in self.code_dirs
+
+    def _stack(self, frame):
+        """
+        Стек потока для агрегации или None, если поток простаивает или не выполняет код приложения.
+        В стек входят только кадры приложения и самый внутренний кадр (где именно тратится время),
+        без номеров строк - один и тот же путь всегда даёт одну и ту же запись
+        """
+        if frame.f_code.co_filename in IDLE_FILES:
+            return None
+        innermost = frame.f_code
+        parts = []
+        while frame is not None:
+            code = frame.f_code
+            if self._is_app_code(code.co_filename):
+                parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        if not parts:
+            return None
+        if not self._is_app_code(innermost.co_filename):
+            parts.insert(0, f"{os.path.basename(innermost.co_filename)}:{innermost.co_name}")
+        return ";".join(reversed(parts))
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while True:
+            if not self.active:
+                self.wakeup.wait()
+                self.wakeup.clear()
+            time.sleep(self.interval)
+
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                stack = self._stack(frame) if thread_id != own_id else None
+                if stack is not None:
+                    stacks.append(stack)
+
+            # Запросы в одном цикле событий не различить, поэтому образец идёт всем активным
+            with self.lock:
+                for samples in self.active.values():
+                    samples.update(stacks)
+
+
+class MetricsMiddleware:
+    """ASGI middleware: время, размеры и статус каждого HTTP-запроса"""
+
+    def __init__(self, app, app_name, routes, profiler=None, slow_threshold=None):
+        self.app = app
+        self.app_name = app_name
+        self.routes = routes
+        self.profiler = profiler
+        self.slow_threshold = slow_threshold
+        if profiler is not None:
+            # Стек стоит замерять, только если в нём есть обработчики приложения (не /metrics, не /docs)
+            for route in routes:
+                code = getattr(getattr(route, "endpoint", None), "__code__", None)
+                if code is not None and code.co_filename != __file__ and not code.co_filename.startswith(LIBRARY_DIRS):
+                    profiler.code_dirs.add(os.path.dirname(code.co_filename))
+
+    def _route_of(self, scope):
+        for route in self.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return getattr(route, "path", "")
+        # Неизвестные пути не попадают в метки как есть, иначе их число не ограничено
+        return "unmatched"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route = self._route_of(scope)
+        labels = {"app": self.app_name, "route": route, "algorithm": "", "image_size": ""}
+        token = _request_labels.set(labels)
+        state = {"status": 500, "request_bytes": 0, "response_bytes": 0}
+
+        async def counting_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                state["request_bytes"] += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                state["response_bytes"] += len(message.get("body", b""))
+            await send(message)
+
+        request_id = object()
+        if self.profiler is not None:
+            self.profiler.start(request_id)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            duration = time.perf_counter() - start
+            _request_labels.reset(token)
+            method = scope["method"]
+
+            REQUEST_DURATION.observe(duration, method=method, status=state["status"], **labels)
+            REQUEST_SIZE.observe(state["request_bytes"], app=self.app_name, route=route, method=method)
+            RESPONSE_SIZE.observe(state["response_bytes"], app=self.app_name, route=route, method=method)
+
+            if self.profiler is not None:
+                samples = self.profiler.stop(request_id)
+                if duration * 1000 >= self.slow_threshold:
+                    SLOW_REQUESTS.inc(app=self.app_name, route=route, method=method)
+                    top = "\n".join(f"  {count:5d} {stack}" for stack, count in samples.most_common(10))
+                    logger.warning("Slow request %s %s: %.1f ms, %d samples\n%s",
+                                   method, scope["path"], duration * 1000, sum(samples.values()), top)
+
+
+def setup_metrics(app, app_name):
+    """Подключает middleware и эндпоинт /metrics к приложению FastAPI"""
+    slow_ms = os.environ.get("LAB_PROFILE_SLOW_MS")
+    profiler = None
+    if slow_ms:
+        interval = float(os.environ.get("LAB_PROFILE_INTERVAL_MS", "5")) / 1000
+        profiler = SamplingProfiler(interval)
+
+    async def metrics_endpoint(request):
+        return Response(render_metrics(), media_type="text/plain; version=0.0.4")
+
+    app.add_route("/metrics", metrics_endpoint, include_in_schema=False)
+    app.add_middleware(MetricsMiddleware, app_name=app_name, routes=app.router.routes,
+                       profiler=profiler, slow_threshold=float(slow_ms) if slow_ms else None)
@@ -1,10 +1,25 @@
 import math
-from fastapi import FastAPI, Request, Form
-from fastapi.responses import HTMLResponse, JSONResponse
+import io
+import os
+import sys
+import uuid
+from collections import OrderedDict
+from typing import List, Tuple
+import cv2
+import numpy as np
+from fastapi import FastAPI, Request, Form, File, UploadFile
+from fastapi.responses import HTMLResponse, JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel, Field
 
+try:
+    from instrumentation import setup_metrics, set_labels, stage, image_size_label, known_label
+except ModuleNotFoundError:
+    # Запуск из каталога лабораторной (python app.py, uvicorn app:app): общий модуль лежит уровнем выше
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from instrumentation import setup_metrics, set_labels, stage, image_size_label, known_label
+
 
 # Модели данных
 
@@ -33,6 +48,10 @@ class AllColorModels(BaseModel):
     hls: HLSColor
 
 
+class NearestRequest(BaseModel):
+    colors: List[Tuple[int, int, int]]
+
+
 
 def rgb_to_cmyk(r: int, g: int, b: int) -> CMYKColor:
     if r == 0 and g == 0 and b == 0:
@@ -129,12 +148,298 @@ def hls_to_rgb(h: int, l: float, s: float) -> RGBColor:
     return RGBColor(r=int(round(r * 255)), g=int(round(g * 255)), b=int(round(b * 255)))
 
 
+# Поиск ближайшего цвета палитры
+
+PALETTE_SPACES = ("rgb", "hls")
+# Палитры до этого размера проверяются полным перебором, большие - через k-d дерево
+BRUTE_FORCE_MAX = 256
+# Цветов в листе дерева (от половины до этого числа), подобрано замером
+LEAF_SIZE = 12
+# Запросов в одном проходе по дереву
+QUERY_BLOCK = 1 << 13
+# Сколько пар "запрос x цвет палитры" считать за один проход
+DISTANCE_BLOCK = 1 << 22
+
+
+def rgb_to_hls_array(rgb: np.ndarray) -> np.ndarray:
+    """Векторный вариант rgb_to_hls (та же формула, без округления) для массива (n, 3)"""
+    rgb_p = rgb.astype(np.float64) / 255.0
+    r_p, g_p, b_p = rgb_p[:, 0], rgb_p[:, 1], rgb_p[:, 2]
+
+    max_val = rgb_p.max(axis=1)
+    min_val = rgb_p.min(axis=1)
+    delta = max_val - min_val
+
+    l = (max_val + min_val) / 2
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        s = np.where(l < 0.5, delta / (max_val + min_val), delta / (2.0 - max_val - min_val))
+        h = np.where(max_val == r_p, (g_p - b_p) / delta,
+                     np.where(max_val == g_p, 2.0 + (b_p - r_p) / delta, 4.0 + (r_p - g_p) / delta))
+
+    # Серый цвет: оттенок и насыщенность 0
+    gray = delta == 0
+    h[gray] = 0
+    s[gray] = 0
+
+    h *= 60
+    h[h < 0] += 360
+    return np.stack([h, l, s], axis=1)
+
+
+def palette_coordinates(rgb: np.ndarray, space: str) -> np.ndarray:
+    """
+    Координаты цветов в пространстве поиска, все оси в пределах [0, 255].
+    HLS раскладывается в цилиндр (s*cos h, s*sin h, l), чтобы оттенки 359 и 0 были рядом.
+    """
+    if space == "rgb":
+        return rgb.astype(np.float64)
+    if space == "hls":
+        hls = rgb_to_hls_array(rgb)
+        angle = np.radians(hls[:, 0])
+        return np.stack([
+            (1 + hls[:, 2] * np.cos(angle)) * 127.5,
+            (1 + hls[:, 2] * np.sin(angle)) * 127.5,
+            hls[:, 1] * 255,
+        ], axis=1)
+    raise ValueError(f"Unknown color space: {space}")
+
+
+def _nearest_brute(queries: np.ndarray, points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Ближайшие точки полным перебором, блоками по DISTANCE_BLOCK пар"""
+    index = np.empty(len(queries), dtype=np.int64)
+    dist2 = np.empty(len(queries))
+    step = max(1, DISTANCE_BLOCK // max(len(points), 1))
+    for a in range(0, len(queries), step):
+        d2 = ((queries[a:a + step, None, :] - points[None, :, :]) ** 2).sum(axis=2)
+        index[a:a + step] = d2.argmin(axis=1)
+        dist2[a:a + step] = d2[np.arange(len(d2)), index[a:a + step]]
+    return index, dist2
+
+
+class PaletteIndex:
+    """
+    Индекс палитры: k-d дерево над различными цветами палитры.
+    Дерево сбалансировано (деление по медиане самой длинной оси), у каждого узла хранится
+    точная рамка его цветов. Запрос сначала берёт ближайшее из своего листа, затем проходит
+    дерево по уровням, отбрасывая узлы, рамка которых дальше найденного, поэтому ответ точный
+    и для запросов далеко за пределами палитры. Все запросы блока идут плоскими массивами.
+    """
+
+    def __init__(self, colors: np.ndarray, space: str = "rgb"):
+        self.colors = np.ascontiguousarray(colors, dtype=np.uint8).reshape(-1, 3)
+        if len(self.colors) == 0:
+            raise ValueError("Palette is empty")
+        self.space = space
+        self.points = palette_coordinates(self.colors, space)
+
+        # Повторы цвета в дерево не попадают: у скученных палитр их большинство, а равные
+        # расстояния не дают отсечь узлы. Остаётся первое вхождение, как у полного перебора
+        packed = (self.colors[:, 0].astype(np.int64) << 16) | (self.colors[:, 1].astype(np.int64) << 8) | self.colors[:, 2]
+        _, self.distinct = np.unique(packed, return_index=True)
+        points = self.points[self.distinct]
+        n = len(points)
+
+        # Узел i на глубине d (номера 2^d..2^(d+1)-1) владеет позициями [k*n >> d, (k+1)*n >> d)
+        # перестановки perm, k = i - 2^d; у детей эти отрезки - половины отрезка родителя
+        self.depth = max(0, int(np.ceil(np.log2(max(n / LEAF_SIZE, 1)))))
+        self.split_axis = np.zeros(2 ** self.depth, dtype=np.int64)
+        self.split_value = np.zeros(2 ** self.depth)
+        perm = np.arange(n)
+        for d in range(self.depth):
+            starts = (np.arange(2 ** d) * n) >> d
+            level_points = points[perm]
+            spread = np.maximum.reduceat(level_points, starts) - np.minimum.reduceat(level_points, starts)
+            axis = spread.argmax(axis=1)
+            node = np.repeat(np.arange(2 ** d), np.diff(np.append(starts, n)))
+            perm = perm[np.lexsort((level_points[np.arange(n), axis[node]], node))]
+            middle = ((2 * np.arange(2 ** d) + 1) * n) >> (d + 1)
+            self.split_axis[2 ** d:2 ** (d + 1)] = axis
+            self.split_value[2 ** d:2 ** (d + 1)] = points[perm[middle], axis]
+
+        self.order = self.distinct[perm]
+        self.sorted_columns = [np.ascontiguousarray(points[perm, axis]) for axis in range(3)]
+        leaves = 2 ** self.depth
+        self.leaf_start = (np.arange(leaves + 1) * n) >> self.depth
+
+        # Рамки узлов снизу вверх: листья по своим цветам, родитель - объединение детей
+        low = np.empty((2 * leaves, 3))
+        high = np.empty((2 * leaves, 3))
+        low[leaves:] = np.minimum.reduceat(points[perm], self.leaf_start[:-1])
+        high[leaves:] = np.maximum.reduceat(points[perm], self.leaf_start[:-1])
+        for d in range(self.depth - 1, -1, -1):
+            ids = np.arange(2 ** d, 2 ** (d + 1))
+            low[ids] = np.minimum(low[2 * ids], low[2 * ids + 1])
+            high[ids] = np.maximum(high[2 * ids], high[2 * ids + 1])
+        self.low_columns = [np.ascontiguousarray(low[:, axis]) for axis in range(3)]
+        self.high_columns = [np.ascontiguousarray(high[:, axis]) for axis in range(3)]
+        self.bounds = (low[1], high[1])
+
+    @staticmethod
+    def _take_better(best, best_d2, rows, index, d2):
+        """Обновляет ответ запросов rows, где кандидат ближе, а при равенстве - раньше в палитре"""
+        better = (d2 < best_d2[rows]) | ((d2 == best_d2[rows]) & (index < best[rows]))
+        best[rows[better]] = index[better]
+        best_d2[rows[better]] = d2[better]
+
+    def _nearest_in_leaves(self, queries: np.ndarray, owner: np.ndarray, leaf: np.ndarray):
+        """
+        Ближайший цвет среди листьев leaf для запросов owner (пары упорядочены по owner).
+        Возвращает индекс в палитре и квадрат расстояния, inf - если пар не было.
+        """
+        best = np.zeros(len(queries), dtype=np.int64)
+        best_d2 = np.full(len(queries), np.inf)
+        starts = self.leaf_start[leaf]
+        lengths = self.leaf_start[leaf + 1] - starts
+
+        # Пары (запрос, цвет) считаются частями не больше DISTANCE_BLOCK
+        pairs = np.cumsum(lengths)
+        cuts = np.searchsorted(pairs, np.arange(DISTANCE_BLOCK, pairs[-1] if len(pairs) else 0, DISTANCE_BLOCK))
+        for a, b in zip(np.concatenate(([0], cuts)), np.concatenate((cuts, [len(leaf)]))):
+            part_lengths = lengths[a:b]
+            candidate = (np.repeat(starts[a:b] - np.cumsum(part_lengths) + part_lengths, part_lengths)
+                         + np.arange(part_lengths.sum()))
+            pair_owner = np.repeat(owner[a:b], part_lengths)
+
+            # По осям отдельно: без временных массивов (пары, 3) и суммы по строкам
+            d2 = np.zeros(len(candidate))
+            for axis in range(3):
+                diff = queries[:, axis][pair_owner] - self.sorted_columns[axis][candidate]
+                d2 += diff * diff
+
+            # Минимум по каждому запросу; из равноудалённых - первый в палитре, как у перебора
+            per_query = np.bincount(pair_owner, minlength=len(queries))
+            has = per_query > 0
+            part_d2 = np.full(len(queries), np.inf)
+            part_d2[has] = np.minimum.reduceat(d2, (np.cumsum(per_query) - per_query)[has])
+            hits = np.flatnonzero(d2 == part_d2[pair_owner])
+            hit_owner = pair_owner[hits]
+            hit_index = self.order[candidate[hits]]
+            by_index = np.lexsort((hit_index, hit_owner))
+            rows, first = np.unique(hit_owner[by_index], return_index=True)
+            # Запрос может попасть на границу частей - из двух частей берётся лучшая
+            self._take_better(best, best_d2, rows, hit_index[by_index][first], part_d2[rows])
+        return best, best_d2
+
+    def _box_distance2(self, queries: np.ndarray, owner: np.ndarray, node: np.ndarray, upper: bool):
+        """
+        Для запросов owner и узлов node: квадрат расстояния до рамки узла (ближе ни одного цвета
+        узла нет) и, если upper, квадрат MinMaxDist (не дальше какой-то цвет узла точно есть -
+        рамка точная, поэтому на каждой её грани лежит цвет)
+        """
+        near = np.zeros(len(node))
+        far = np.zeros(len(node)) if upper else None
+        swap = np.full(len(node), np.inf) if upper else None
+        for axis in range(3):
+            q = queries[:, axis][owner]
+            low = self.low_columns[axis][node]
+            high = self.high_columns[axis][node]
+            gap = np.maximum(np.maximum(low - q, q - high), 0)
+            near += gap * gap
+            if upper:
+                # Ближняя и дальняя грань по оси
+                lower_half = 2 * q <= low + high
+                to_near = q - np.where(lower_half, low, high)
+                to_far = q - np.where(lower_half, high, low)
+                far += to_far * to_far
+                np.minimum(swap, to_near * to_near - to_far * to_far, out=swap)
+        return near, far + swap if upper else None
+
+    def _query_block(self, queries: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        leaves = 2 ** self.depth
+        rows = np.arange(len(queries))
+
+        # Спуск по плоскостям деления к листу; запрос вне палитры сначала прижимается к её рамке,
+        # иначе он попал бы в далёкий от ответа лист
+        inside = np.clip(queries, *self.bounds)
+        node = np.ones(len(queries), dtype=np.int64)
+        for _ in range(self.depth):
+            node = 2 * node + (inside[rows, self.split_axis[node]] >= self.split_value[node])
+        best, best_d2 = self._nearest_in_leaves(queries, rows, node - leaves)
+
+        # Обход по уровням: пара (запрос, узел) остаётся, пока рамка узла не дальше порога.
+        # Порог - лучшая верхняя оценка: найденное расстояние или MinMaxDist узлов уровня;
+        # с ней мелкие рамки нижних уровней отсекают почти всё, даже для далёких запросов.
+        # Небольшой запас - от ошибок округления, иначе можно отсечь лист с ответом
+        limit = best_d2 * (1 + 1e-9)
+        owner = rows
+        node = np.ones(len(queries), dtype=np.int64)
+        for level in range(self.depth):
+            owner = np.repeat(owner, 2)
+            node = np.stack([2 * node, 2 * node + 1], axis=1).ravel()
+            # Рамки верхних уровней слишком велики, чтобы оценка сверху что-то дала
+            upper = 2 * level >= self.depth
+            near, far = self._box_distance2(queries, owner, node, upper)
+            if upper and len(node):
+                # Пары упорядочены по запросу - минимум по группам
+                count = np.bincount(owner, minlength=len(queries))
+                has = np.flatnonzero(count)
+                group_far = np.minimum.reduceat(far, (np.cumsum(count) - count)[has])
+                limit[has] = np.minimum(limit[has], group_far * (1 + 1e-9))
+            keep = near <= limit[owner]
+            owner, node = owner[keep], node[keep]
+
+        found, found_d2 = self._nearest_in_leaves(queries, owner, node - leaves)
+        self._take_better(best, best_d2, rows, found, found_d2)
+        return best, best_d2
+
+    def query_points(self, queries: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Ближайший цвет палитры для точек (n, 3) пространства поиска: индексы и расстояния"""
+        if len(self.points) <= BRUTE_FORCE_MAX or len(queries) == 0:
+            index, dist2 = _nearest_brute(queries, self.points)
+            return index, np.sqrt(dist2)
+
+        index = np.empty(len(queries), dtype=np.int64)
+        dist2 = np.empty(len(queries))
+        # Запросы идут блоками, чтобы число пар (запрос, узел) не росло без ограничений
+        for a in range(0, len(queries), QUERY_BLOCK):
+            index[a:a + QUERY_BLOCK], dist2[a:a + QUERY_BLOCK] = self._query_block(queries[a:a + QUERY_BLOCK])
+        return index, np.sqrt(dist2)
+
+    def query(self, rgb: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Ближайшие цвета палитры для RGB-цветов (n, 3)"""
+        rgb = np.asarray(rgb, dtype=np.uint8).reshape(-1, 3)
+        # Одинаковые цвета ищутся один раз
+        packed = (rgb[:, 0].astype(np.int64) << 16) | (rgb[:, 1].astype(np.int64) << 8) | rgb[:, 2]
+        unique, inverse = np.unique(packed, return_inverse=True)
+        unique_rgb = np.stack([unique >> 16, (unique >> 8) & 255, unique & 255], axis=1).astype(np.uint8)
+        index, dist = self.query_points(palette_coordinates(unique_rgb, self.space))
+        return index[inverse], dist[inverse]
+
+    def map_image(self, img: np.ndarray) -> np.ndarray:
+        """Замена каждого пикселя BGR-изображения ближайшим цветом палитры"""
+        rgb = img[:, :, ::-1].reshape(-1, 3)
+        index, _ = self.query(rgb)
+        return self.colors[index][:, ::-1].reshape(img.shape)
+
+
+def parse_palette(text: str) -> np.ndarray:
+    """Цвета палитры из текста: по строке "r g b" (или "r,g,b") либо "#rrggbb" на цвет"""
+    if "#" in text:
+        lines = [line.strip().lstrip("#") for line in text.splitlines() if line.strip()]
+        values = np.array([int(line, 16) for line in lines], dtype=np.int64)
+        if np.any(values > 0xFFFFFF) or np.any(values < 0):
+            raise ValueError("Bad hex color")
+        return np.stack([values >> 16, (values >> 8) & 255, values & 255], axis=1).astype(np.uint8)
+
+    values = np.array(text.replace(",", " ").split(), dtype=np.int64)
+    if len(values) % 3:
+        raise ValueError("Number of components is not a multiple of 3")
+    if np.any(values < 0) or np.any(values > 255):
+        raise ValueError("Color components must be in [0, 255]")
+    return values.reshape(-1, 3).astype(np.uint8)
+
+
 # Приложение FastAPI
 
+# Шаблоны ищутся рядом с модулем, а не в текущем каталоге
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
 app = FastAPI(title="Lab 1: Color Models (Corrected Math)")
+setup_metrics(app, "lab_1")
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
+app.mount("/static", StaticFiles(directory=os.path.join(BASE_DIR, "static")), name="static")
+templates = Jinja2Templates(directory=os.path.join(BASE_DIR, "templates"))
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -151,30 +456,36 @@ async def get_main_page(request: Request):
     })
 
 
+COLOR_MODELS = ("rgb", "cmyk", "hls")
+
+
 @app.post("/convert", response_model=AllColorModels)
 async def convert_color(source_model: str = Form(...), values: str = Form(...)):
     import json
-    v = json.loads(values)
+    set_labels(algorithm=known_label(source_model, COLOR_MODELS))
+    with stage("parse"):
+        v = json.loads(values)
 
     rgb = RGBColor(r=0, g=0, b=0)
     cmyk = CMYKColor(c=0, m=0, y=0, k=1)
     hls = HLSColor(h=0, l=0, s=0)
 
     try:
-        if source_model == "rgb":
-            rgb = RGBColor(r=int(v['r']), g=int(v['g']), b=int(v['b']))
-            cmyk = rgb_to_cmyk(rgb.r, rgb.g, rgb.b)
-            hls = rgb_to_hls(rgb.r, rgb.g, rgb.b)
-
-        elif source_model == "cmyk":
-            cmyk = CMYKColor(c=float(v['c']), m=float(v['m']), y=float(v['y']), k=float(v['k']))
-            rgb = cmyk_to_rgb(cmyk.c, cmyk.m, cmyk.y, cmyk.k)
-            hls = rgb_to_hls(rgb.r, rgb.g, rgb.b)
-
-        elif source_model == "hls":
-            hls = HLSColor(h=int(v['h']), l=float(v['l']), s=float(v['s']))
-            rgb = hls_to_rgb(hls.h, hls.l, hls.s)
-            cmyk = rgb_to_cmyk(rgb.r, rgb.g, rgb.b)
+        with stage("compute"):
+            if source_model == "rgb":
+                rgb = RGBColor(r=int(v['r']), g=int(v['g']), b=int(v['b']))
+                cmyk = rgb_to_cmyk(rgb.r, rgb.g, rgb.b)
+                hls = rgb_to_hls(rgb.r, rgb.g, rgb.b)
+
+            elif source_model == "cmyk":
+                cmyk = CMYKColor(c=float(v['c']), m=float(v['m']), y=float(v['y']), k=float(v['k']))
+                rgb = cmyk_to_rgb(cmyk.c, cmyk.m, cmyk.y, cmyk.k)
+                hls = rgb_to_hls(rgb.r, rgb.g, rgb.b)
+
+            elif source_model == "hls":
+                hls = HLSColor(h=int(v['h']), l=float(v['l']), s=float(v['s']))
+                rgb = hls_to_rgb(hls.h, hls.l, hls.s)
+                cmyk = rgb_to_cmyk(rgb.r, rgb.g, rgb.b)
 
         return AllColorModels(rgb=rgb, cmyk=cmyk, hls=hls)
 
@@ -183,7 +494,129 @@ async def convert_color(source_model: str = Form(...), values: str = Form(...)):
         return JSONResponse(status_code=400, content={"message": "Error"})
 
 
+# Палитры, загруженные для поиска ближайшего цвета (самые старые вытесняются)
+
+MAX_PALETTES = 8
+palettes = OrderedDict()
+
+
+def get_palette(palette_id: str):
+    index = palettes.get(palette_id)
+    if index is not None:
+        palettes.move_to_end(palette_id)
+    return index
+
+
+@app.post("/palette")
+async def upload_palette(
+        colors: str = Form(None),
+        file: UploadFile = File(None),
+        data_format: str = Form("text"),  # "text" или "binary" (байты r, g, b подряд)
+        space: str = Form("rgb")  # "rgb" или "hls"
+):
+    set_labels(algorithm=known_label(space, PALETTE_SPACES))
+    try:
+        contents = await file.read() if file is not None else None
+        with stage("parse"):
+            if contents is not None:
+                if data_format == "binary":
+                    if len(contents) % 3:
+                        raise ValueError("File size is not a multiple of 3")
+                    palette = np.frombuffer(contents, np.uint8).reshape(-1, 3)
+                else:
+                    palette = parse_palette(contents.decode("utf-8"))
+            elif colors is not None:
+                palette = parse_palette(colors)
+            else:
+                raise ValueError("No palette colors")
+
+        with stage("compute"):
+            index = PaletteIndex(palette, space)
+    except Exception as e:
+        print(f"Error: {e}")
+        return JSONResponse(status_code=400, content={"message": str(e)})
+
+    palette_id = uuid.uuid4().hex
+    palettes[palette_id] = index
+    if len(palettes) > MAX_PALETTES:
+        palettes.popitem(last=False)
+
+    return {"palette_id": palette_id, "size": len(index.colors), "space": space}
+
+
+@app.delete("/palette/{palette_id}")
+async def delete_palette(palette_id: str):
+    if palettes.pop(palette_id, None) is None:
+        return JSONResponse(status_code=404, content={"message": "Palette not found"})
+    return {"status": "ok"}
+
+
+@app.post("/palette/{palette_id}/nearest")
+async def nearest_colors(palette_id: str, request: NearestRequest):
+    index = get_palette(palette_id)
+    if index is None:
+        return JSONResponse(status_code=404, content={"message": "Palette not found"})
+
+    set_labels(algorithm=index.space)
+    with stage("parse"):
+        queries = np.array(request.colors, dtype=np.int64).reshape(-1, 3)
+    if np.any(queries < 0) or np.any(queries > 255):
+        return JSONResponse(status_code=400, content={"message": "Color components must be in [0, 255]"})
+
+    with stage("compute"):
+        found, distances = index.query(queries.astype(np.uint8))
+    # JSONResponse кодирует тело сразу, поэтому кодирование тоже входит в этап serialize
+    with stage("serialize"):
+        return JSONResponse({
+            "indices": found.tolist(),
+            "colors": index.colors[found].tolist(),
+            "distances": distances.tolist(),
+        })
+
+
+@app.post("/palette/{palette_id}/nearest_binary")
+async def nearest_colors_binary(palette_id: str, request: Request):
+    """Пакетный запрос без JSON: тело - байты r, g, b подряд, ответ - .npz с indices и distances"""
+    index = get_palette(palette_id)
+    if index is None:
+        return JSONResponse(status_code=404, content={"message": "Palette not found"})
+
+    body = await request.body()
+    if len(body) % 3:
+        return JSONResponse(status_code=400, content={"message": "Body size is not a multiple of 3"})
+
+    set_labels(algorithm=index.space)
+    with stage("compute"):
+        found, distances = index.query(np.frombuffer(body, np.uint8).reshape(-1, 3))
+    with stage("serialize"):
+        buffer = io.BytesIO()
+        np.savez(buffer, indices=found, distances=distances)
+    return Response(content=buffer.getvalue(), media_type="application/octet-stream")
+
+
+@app.post("/palette/{palette_id}/map_image")
+async def map_image(palette_id: str, file: UploadFile = File(...)):
+    """Перекрашивает изображение в цвета палитры, ответ - PNG"""
+    index = get_palette(palette_id)
+    if index is None:
+        return JSONResponse(status_code=404, content={"message": "Palette not found"})
+
+    contents = await file.read()
+    with stage("parse"):
+        img = cv2.imdecode(np.frombuffer(contents, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        return JSONResponse(status_code=400, content={"message": "Cannot decode image"})
+
+    set_labels(algorithm=index.space, image_size=image_size_label(img))
+    with stage("compute"):
+        mapped = index.map_image(img)
+    with stage("encode"):
+        _, buffer = cv2.imencode(".png", mapped)
+    return Response(content=buffer.tobytes(), media_type="image/png")
+
+
 if __name__ == "__main__":
+    # python -m lab_1.app из корня репозитория или python app.py из каталога lab_1
     import uvicorn
 
     uvicorn.run(app, host="127.0.0.1", port=8000)
\ No newline at end of file
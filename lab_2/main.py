@@ -1,17 +1,56 @@
+import asyncio
+import json
+import os
+import sys
+import threading
+import weakref
 import cv2
 import numpy as np
 import base64
-from fastapi import FastAPI, File, UploadFile, Form, Request
+from collections import OrderedDict
+from functools import partial
+from fastapi import FastAPI, File, UploadFile, Form, Request, WebSocket, WebSocketDisconnect
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 
+try:
+    from instrumentation import setup_metrics, set_labels, stage, request_labels, image_size_label, known_label
+except ModuleNotFoundError:
+    # Запуск из каталога лабораторной (python main.py, uvicorn main:app): общий модуль лежит уровнем выше
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from instrumentation import setup_metrics, set_labels, stage, request_labels, image_size_label, known_label
+
+# Шаблоны ищутся рядом с модулем, а не в текущем каталоге
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
 app = FastAPI()
-templates = Jinja2Templates(directory="templates")
+setup_metrics(app, "lab_2")
+templates = Jinja2Templates(directory=os.path.join(BASE_DIR, "templates"))
 
 
 last_uploaded_image = None
 
+# Кэш адаптивной бинаризации: для каждого изображения хранится его серый вариант
+# и разность "яркость - локальное среднее" для уже встречавшихся (method, block_size).
+# При смене только c_val фильтр не пересчитывается, остаётся одно сравнение.
+# Изображение кэш держит по слабой ссылке: когда его заменили в /upload и в сессиях
+# WebSocket, запись удаляется вместе с ним. Общий объём записей ограничен в байтах.
+THRESHOLD_CACHE_BYTES = 256 << 20
+threshold_cache = OrderedDict()
+# Обработка из WebSocket идёт в потоках, поэтому доступ к кэшу под блокировкой.
+# RLock - на случай, если изображение освободится в потоке, уже держащем блокировку
+threshold_lock = threading.RLock()
+
+
+def encode_frame(img, params):
+    """Обработка и быстрое PNG-сжатие кадра для WebSocket"""
+    with stage("compute"):
+        processed_img = process_image(img, **params)
+    with stage("encode"):
+        _, buffer = cv2.imencode('.png', processed_img, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    return buffer.tobytes()
+
 
 def image_to_base64(img):
     if img is None: return None
@@ -27,6 +66,111 @@ async def read_image(file: UploadFile):
     return img
 
 
+def _window_sums(rows, r):
+    """
+    Суммы по окну 2r+1 вдоль строк с краями BORDER_REPLICATE: окно, вышедшее за край,
+    добирает недостающее крайним значением, поэтому дополнять массив не нужно
+    """
+    h, w = rows.shape
+    cumulative = np.zeros((h, w + 1), dtype=np.int64)
+    np.cumsum(rows, axis=1, out=cumulative[:, 1:])
+
+    x = np.arange(w)
+    sums = cumulative[:, np.minimum(x + r, w - 1) + 1] - cumulative[:, np.maximum(x - r, 0)]
+    sums += np.maximum(r - x, 0) * rows[:, :1].astype(np.int64)
+    sums += np.maximum(x + r - (w - 1), 0) * rows[:, -1:].astype(np.int64)
+    return sums
+
+
+def local_mean(gray, block_size):
+    """
+    Среднее по окну block_size x block_size с теми же краями (BORDER_REPLICATE)
+    и округлением, что у cv2.boxFilter. Окно раскладывается на проходы по строкам
+    и столбцам, память не зависит от block_size
+    """
+    r = block_size // 2
+    sums = _window_sums(_window_sums(gray, r).T, r).T
+    return np.rint(sums / (block_size * block_size)).astype(np.uint8)
+
+
+def local_gaussian_mean(gray, block_size):
+    """Взвешенное гауссом среднее - так же, как внутри cv2.adaptiveThreshold"""
+    blurred = cv2.GaussianBlur(gray.astype(np.float32), (block_size, block_size), 0, 0,
+                               borderType=cv2.BORDER_REPLICATE | cv2.BORDER_ISOLATED)
+    return np.clip(np.rint(blurred), 0, 255).astype(np.uint8)
+
+
+def _forget_image(image_id, ref):
+    """Изображение больше нигде не используется - его карты тоже не нужны"""
+    with threshold_lock:
+        entry = threshold_cache.get(image_id)
+        if entry is not None and entry["ref"] is ref:
+            del threshold_cache[image_id]
+
+
+def _entry_bytes(entry):
+    return entry["gray"].nbytes + sum(diff.nbytes for diff in entry["diffs"].values())
+
+
+def _trim_threshold_cache(current, keep):
+    """Вытесняет давние изображения, затем старые карты текущего, пока кэш больше лимита"""
+    total = sum(_entry_bytes(entry) for entry in threshold_cache.values())
+    while total > THRESHOLD_CACHE_BYTES:
+        oldest = next(iter(threshold_cache))
+        if oldest != current:
+            total -= _entry_bytes(threshold_cache.pop(oldest))
+            continue
+        diffs = threshold_cache[current]["diffs"]
+        oldest = next(iter(diffs))
+        # Только что посчитанная карта остаётся, даже если одна превышает лимит
+        if oldest == keep:
+            break
+        total -= diffs.pop(oldest).nbytes
+
+
+def threshold_diff(img, method, block_size):
+    """Разность яркости и локального среднего из кэша (или посчитанная и сохранённая)"""
+    key = (method, block_size)
+    with threshold_lock:
+        entry = threshold_cache.get(id(img))
+        # Проверка по ссылке: id мог перейти к другому объекту
+        if entry is None or entry["ref"]() is not img:
+            entry = {"ref": weakref.ref(img, partial(_forget_image, id(img))),
+                     "gray": cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), "diffs": {}}
+            threshold_cache[id(img)] = entry
+        else:
+            threshold_cache.move_to_end(id(img))
+        diff = entry["diffs"].get(key)
+    if diff is not None:
+        return diff
+
+    # Сам фильтр считается вне блокировки, чтобы не задерживать другие сессии
+    gray = entry["gray"]
+    if method == "adaptive_mean":
+        mean = local_mean(gray, block_size)
+    else:
+        mean = local_gaussian_mean(gray, block_size)
+    diff = gray.astype(np.int16) - mean
+
+    with threshold_lock:
+        # Пока считали, запись могли вытеснить - тогда карта просто не сохраняется
+        if threshold_cache.get(id(img)) is entry:
+            entry["diffs"][key] = diff
+            _trim_threshold_cache(id(img), key)
+    return diff
+
+
+def adaptive_threshold(img, method, block_size, c_val):
+    """
+    Аналог cv2.adaptiveThreshold(..., THRESH_BINARY) с побитово тем же результатом:
+    пиксель белый, если яркость - среднее > -c_val
+    """
+    diff = threshold_diff(img, method, block_size)
+    binary = np.greater(diff, -c_val).view(np.uint8)
+    binary *= 255
+    return binary
+
+
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
@@ -35,8 +179,37 @@ async def home(request: Request):
 @app.post("/upload")
 async def upload_image(file: UploadFile = File(...)):
     global last_uploaded_image
-    last_uploaded_image = await read_image(file)
-    return JSONResponse({"status": "ok", "image": image_to_base64(last_uploaded_image)})
+    with stage("parse"):
+        last_uploaded_image = await read_image(file)
+        # Метка внутри блока, чтобы она попала и в замер самого разбора
+        set_labels(image_size=image_size_label(last_uploaded_image))
+    with stage("encode"):
+        encoded = image_to_base64(last_uploaded_image)
+    return JSONResponse({"status": "ok", "image": encoded})
+
+
+METHODS = ("median", "adaptive_mean", "adaptive_gaussian")
+
+
+def process_image(original_img, method, kernel_size=5, block_size=11, c_val=2):
+    """Обработка выбранным методом; исходное изображение не изменяется"""
+
+    # --- ЛОГИКА ОБРАБОТКИ ---
+
+    if method == "median":
+        # Ядро должно быть нечетным
+        if kernel_size % 2 == 0: kernel_size += 1
+        return cv2.medianBlur(original_img, kernel_size)
+
+    elif method in ("adaptive_mean", "adaptive_gaussian"):
+        # Размер блока должен быть нечетным и > 1
+        if block_size % 2 == 0: block_size += 1
+        if block_size < 3: block_size = 3
+
+        processed_img = adaptive_threshold(original_img, method, block_size, c_val)
+        return cv2.cvtColor(processed_img, cv2.COLOR_GRAY2BGR)
+
+    return original_img
 
 
 @app.post("/api/process")
@@ -51,48 +224,93 @@ async def api_process_image(
     if last_uploaded_image is None:
         return JSONResponse({"error": "No image uploaded"}, status_code=400)
 
-    original_img = last_uploaded_image.copy()
-    processed_img = None
+    set_labels(algorithm=known_label(method, METHODS), image_size=image_size_label(last_uploaded_image))
 
-    # --- ЛОГИКА ОБРАБОТКИ ---
+    # Фильтры не изменяют исходник, поэтому копия не нужна (кэш бинаризации привязан к объекту)
+    with stage("compute"):
+        processed_img = process_image(last_uploaded_image, method, kernel_size, block_size, c_val)
 
-    if method == "median":
-        # Ядро должно быть нечетным
-        if kernel_size % 2 == 0: kernel_size += 1
-        processed_img = cv2.medianBlur(original_img, kernel_size)
+    with stage("encode"):
+        encoded = image_to_base64(processed_img)
+    return JSONResponse({
+        "processed_image": encoded
+    })
 
-    elif method == "adaptive_mean":
-        gray = cv2.cvtColor(original_img, cv2.COLOR_BGR2GRAY)
-        # Размер блока должен быть нечетным и > 1
-        if block_size % 2 == 0: block_size += 1
-        if block_size < 3: block_size = 3
 
-        processed_img = cv2.adaptiveThreshold(
-            gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C,
-            cv2.THRESH_BINARY, block_size, c_val
-        )
-        processed_img = cv2.cvtColor(processed_img, cv2.COLOR_GRAY2BGR)
+@app.websocket("/ws/process")
+async def ws_process_image(websocket: WebSocket):
+    """
+    Канал для живой настройки параметров.
+    Текстовое сообщение - JSON с параметрами (method, kernel_size, block_size, c_val),
+    бинарное - изображение для этой сессии. Если его не прислали, сессия при первых
+    параметрах запоминает последнее из /upload, и чужие загрузки её больше не меняют.
+    В ответ приходят бинарные кадры PNG. Пока идёт обработка, новые параметры
+    только заменяют ожидающие: устаревшие запросы отбрасываются, считается последний.
+    """
+    await websocket.accept()
 
-    elif method == "adaptive_gaussian":
-        gray = cv2.cvtColor(original_img, cv2.COLOR_BGR2GRAY)
-        if block_size % 2 == 0: block_size += 1
-        if block_size < 3: block_size = 3
+    session = {"image": None, "params": None}
+    pending = asyncio.Event()
 
-        processed_img = cv2.adaptiveThreshold(
-            gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-            cv2.THRESH_BINARY, block_size, c_val
-        )
-        processed_img = cv2.cvtColor(processed_img, cv2.COLOR_GRAY2BGR)
+    async def worker():
+        while True:
+            await pending.wait()
+            pending.clear()
+            # Берутся самые свежие параметры, всё пришедшее за время прошлой обработки схлопывается
+            params = session["params"]
 
-    else:
-        processed_img = original_img
+            img = session["image"]
+            if img is None:
+                await websocket.send_json({"error": "No image uploaded"})
+                continue
 
-    return JSONResponse({
-        "processed_image": image_to_base64(processed_img)
-    })
+            try:
+                # Обработка в потоке, чтобы цикл событий продолжал принимать новые параметры
+                with request_labels("lab_2", "/ws/process"):
+                    set_labels(algorithm=known_label(params["method"], METHODS), image_size=image_size_label(img))
+                    frame = await asyncio.to_thread(encode_frame, img, params)
+            except Exception as e:
+                await websocket.send_json({"error": str(e)})
+                continue
+            await websocket.send_bytes(frame)
+
+    worker_task = asyncio.create_task(worker())
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+
+            if message.get("bytes") is not None:
+                img = cv2.imdecode(np.frombuffer(message["bytes"], np.uint8), cv2.IMREAD_COLOR)
+                if img is None:
+                    await websocket.send_json({"error": "Cannot decode image"})
+                    continue
+                session["image"] = img
+            else:
+                try:
+                    data = json.loads(message["text"])
+                    session["params"] = {
+                        "method": str(data["method"]),
+                        "kernel_size": int(data.get("kernel_size", 5)),
+                        "block_size": int(data.get("block_size", 11)),
+                        "c_val": int(data.get("c_val", 2)),
+                    }
+                except (ValueError, KeyError, TypeError) as e:
+                    await websocket.send_json({"error": f"Bad parameters: {e}"})
+                    continue
+                if session["image"] is None:
+                    session["image"] = last_uploaded_image
+            if session["params"] is not None:
+                pending.set()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        worker_task.cancel()
 
 
 if __name__ == "__main__":
+    # python -m lab_2.main из корня репозитория или python main.py из каталога lab_2
     import uvicorn
 
     uvicorn.run(app, host="127.0.0.1", port=8000)
\ No newline at end of file
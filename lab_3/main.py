@@ -1,4 +1,6 @@
 import math
+import os
+import sys
 import time
 from typing import List, Tuple, Optional
 from fastapi import FastAPI, Request
@@ -6,8 +8,19 @@ from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
 
+try:
+    from instrumentation import setup_metrics, set_labels, stage
+except ModuleNotFoundError:
+    # Запуск из каталога лабораторной (python main.py, uvicorn main:app): общий модуль лежит уровнем выше
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from instrumentation import setup_metrics, set_labels, stage
+
+# Шаблоны ищутся рядом с модулем, а не в текущем каталоге
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
 app = FastAPI()
-templates = Jinja2Templates(directory="templates")
+setup_metrics(app, "lab_3")
+templates = Jinja2Templates(directory=os.path.join(BASE_DIR, "templates"))
 
 
 class DrawRequest(BaseModel):
@@ -291,6 +304,8 @@ async def calculate_points(data: DrawRequest):
         args = [data.x1, data.y1, data.x2, data.y2]
 
     if algo_func:
+        set_labels(algorithm=data.algorithm)
+
         # Прогрев
         algo_func(*args)
 
@@ -300,10 +315,11 @@ async def calculate_points(data: DrawRequest):
         if data.algorithm in ["wu", "castle_pitteway"]:
             ITERATIONS = 500
 
-        start_time = time.perf_counter_ns()
-        for _ in range(ITERATIONS):
-            result_points = algo_func(*args)
-        end_time = time.perf_counter_ns()
+        with stage("compute"):
+            start_time = time.perf_counter_ns()
+            for _ in range(ITERATIONS):
+                result_points = algo_func(*args)
+            end_time = time.perf_counter_ns()
 
         avg_time = (end_time - start_time) / ITERATIONS
 
@@ -315,6 +331,7 @@ async def calculate_points(data: DrawRequest):
 
 
 if __name__ == "__main__":
+    # python -m lab_3.main из корня репозитория или python main.py из каталога lab_3
     import uvicorn
 
     uvicorn.run(app, host="127.0.0.1", port=8000)
\ No newline at end of file
@@ -1,12 +1,32 @@
-from fastapi import FastAPI, Request, Form
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, Request, Form, File, UploadFile
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
 from typing import List, Tuple, Optional
+import asyncio
+import io
+import json
 import math
+import multiprocessing
+import os
+import sys
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+try:
+    from instrumentation import setup_metrics, set_labels, stage, known_label
+except ModuleNotFoundError:
+    # Запуск из каталога лабораторной (python main.py, uvicorn main:app): общий модуль лежит уровнем выше
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from instrumentation import setup_metrics, set_labels, stage, known_label
+
+# Шаблоны ищутся рядом с модулем, а не в текущем каталоге
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 app = FastAPI()
-templates = Jinja2Templates(directory="templates")
+setup_metrics(app, "lab_4")
+templates = Jinja2Templates(directory=os.path.join(BASE_DIR, "templates"))
 
 
 # --- Модели данных ---
@@ -80,75 +100,526 @@ def midpoint_clip_line(p1: Point, p2: Point, win: Rect, precision=0.1) -> Option
         return None
 
 
+# Предел глубины деления: дальше номер куска k не помещается в int64
+MIDPOINT_MAX_DEPTH = 60
+
+
+def _region_codes(x: np.ndarray, y: np.ndarray, win_values: np.ndarray) -> np.ndarray:
+    """Векторный аналог get_region_code, окно [xmin, ymin, xmax, ymax] или своё для каждой точки"""
+    win_values = np.atleast_2d(win_values)
+    return ((x < win_values[:, 0]) * 1 | (x > win_values[:, 2]) * 2
+            | (y < win_values[:, 1]) * 4 | (y > win_values[:, 3]) * 8)
+
+
+def _midpoint_clip_chunk(segments: np.ndarray, win_values: np.ndarray, precision: float) -> Tuple[np.ndarray, np.ndarray]:
+    # Рабочий список кусков: координаты, номер исходного отрезка и положение куска
+    # на отрезке в виде номера k на уровне деления depth (кусок = [k / 2^depth, (k + 1) / 2^depth])
+    x1, y1, x2, y2 = segments.T
+    source = np.arange(len(segments))
+    k = np.zeros(len(segments), dtype=np.int64)
+    depth = np.zeros(len(segments), dtype=np.int64)
+
+    accepted = []
+    while len(source):
+        win = win_values if win_values.ndim == 1 else win_values[source]
+        code1 = _region_codes(x1, y1, win)
+        code2 = _region_codes(x2, y2, win)
+
+        # Тривиальное принятие
+        accept = (code1 | code2) == 0
+        if accept.any():
+            accepted.append((source[accept], k[accept], depth[accept],
+                             np.stack([x1[accept], y1[accept], x2[accept], y2[accept]], axis=1)))
+
+        # Тривиальное отвержение и куски меньше точности отбрасываются, остальные делятся пополам
+        dx = x1 - x2
+        dy = y1 - y2
+        split = ~accept & ((code1 & code2) == 0) & (np.sqrt(dx * dx + dy * dy) >= precision)
+
+        x1, y1, x2, y2 = x1[split], y1[split], x2[split], y2[split]
+        mx = (x1 + x2) / 2
+        my = (y1 + y2) / 2
+
+        # Бесконечные координаты или огромные отрезки никогда не станут короче точности:
+        # рекурсивная версия падала с RecursionError, здесь деление прерывается явно
+        if (depth[split] >= MIDPOINT_MAX_DEPTH).any() or not np.isfinite(mx).all() or not np.isfinite(my).all() \
+                or (((mx == x1) & (my == y1)) | ((mx == x2) & (my == y2))).any():
+            raise ValueError("Отрезок не удаётся разделить до заданной точности")
+        x1, y1, x2, y2 = (np.concatenate((x1, mx)), np.concatenate((y1, my)),
+                          np.concatenate((mx, x2)), np.concatenate((my, y2)))
+        source = np.tile(source[split], 2)
+        k = np.concatenate((2 * k[split], 2 * k[split] + 1))
+        depth = np.tile(depth[split] + 1, 2)
+
+    if not accepted:
+        return np.empty((0, 4)), np.empty(0, dtype=np.int64)
+
+    source, k, depth, coords = (np.concatenate(a) for a in zip(*accepted))
+
+    # Видимая часть отрезка - от начала первого принятого куска до конца последнего
+    start = np.ldexp(k.astype(np.float64), -depth)
+    end = np.ldexp((k + 1).astype(np.float64), -depth)
+    first = np.lexsort((start, source))
+    last = np.lexsort((-end, source))
+    is_first = np.concatenate(([True], source[first][1:] != source[first][:-1]))
+
+    result = np.empty((is_first.sum(), 4))
+    result[:, :2] = coords[first[is_first], :2]
+    result[:, 2:] = coords[last[is_first], 2:]
+    return result, source[first[is_first]]
+
+
+async def midpoint_clip_lines(segments: np.ndarray, win_values: np.ndarray, precision=0.1) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Алгоритм средней точки сразу для массива отрезков (n, 4).
+    Окно [xmin, ymin, xmax, ymax] общее или своё для каждого отрезка (n, 4).
+    Вместо рекурсии все куски делятся пополам одновременно, результат совпадает
+    с midpoint_clip_line. Возвращает видимые части (m, 4) и номера исходных отрезков.
+    """
+    segments = np.asarray(segments, dtype=np.float64).reshape(-1, 4)
+    win_values = np.asarray(win_values, dtype=np.float64)
+
+    workers = os.cpu_count() or 1
+    if len(segments) * 2 < PARALLEL_MIN_VERTICES or workers < 2:
+        return _midpoint_clip_chunk(segments, win_values, precision)
+
+    cuts = np.linspace(0, len(segments), workers + 1).astype(np.int64)
+    results = await _run_in_pool(_midpoint_clip_chunk, [
+        (segments[a:b], win_values if win_values.ndim == 1 else win_values[a:b], precision)
+        for a, b in zip(cuts[:-1], cuts[1:])
+    ])
+    return (np.concatenate([r for r, _ in results]),
+            np.concatenate([index + a for (_, index), a in zip(results, cuts[:-1])]))
+
+
 # --- 2. Алгоритм Сазерленда-Ходжмана (Отсечение выпуклого многоугольника) ---
 
+# Полигоны хранятся упакованно: все вершины подряд в массиве (N, 2),
+# а offsets (P + 1) задаёт границы: вершины полигона i - vertices[offsets[i]:offsets[i + 1]]
+
+# Начиная с этого числа вершин пакет делится между процессами
+PARALLEL_MIN_VERTICES = 1_000_000
+
+_process_pool = None
+
+
+# Порядок обхода окна: Лево, Право, Низ, Верх - и соответствующие столбцы [xmin, ymin, xmax, ymax]
+WINDOW_EDGES = (0, 2, 1, 3)
+
+
+def _clip_stage(vertices: np.ndarray, offsets: np.ndarray, edge: int, bound: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Один проход Сазерленда-Ходжмана по краю окна сразу для всех полигонов.
+    bound - координата края для каждой вершины (у разных полигонов могут быть разные окна).
+    """
+    n = len(vertices)
+    if n == 0:
+        return vertices, offsets
+
+    # S - предыдущая вершина для каждой E, с замыканием внутри своего полигона
+    lengths = np.diff(offsets)
+    non_empty = lengths > 0
+    prev = np.arange(-1, n - 1)
+    prev[offsets[:-1][non_empty]] = offsets[1:][non_empty] - 1
+
+    coord = vertices[:, edge // 2]
+    if edge == 0 or edge == 2:  # Left / Bottom
+        inside = coord >= bound
+    else:  # Right / Top
+        inside = coord <= bound
+    inside_s = inside[prev]
+
+    # На каждую E выводится пересечение (если S и E по разные стороны) и сама E (если внутри)
+    crossing = inside != inside_s
+    counts = crossing.astype(np.int64) + inside
+    ends = np.cumsum(counts)
+
+    output = np.empty((ends[-1], 2))
+    output[ends[inside] - 1] = vertices[inside]
+
+    s = vertices[prev[crossing]]
+    e = vertices[crossing]
+    dx = e[:, 0] - s[:, 0]
+    dy = e[:, 1] - s[:, 1]
+
+    # Та же формула, что и у поточечного варианта: y = y1 + slope * (x - x1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = np.where(dx != 0, dy / dx, 0.0)
+        if edge < 2:  # Left / Right: x = bound
+            x = bound[crossing]
+            y = s[:, 1] + slope * (x - s[:, 0])
+        else:  # Bottom / Top: y = bound
+            y = bound[crossing]
+            x = np.where(dx == 0, s[:, 0], s[:, 0] + (y - s[:, 1]) / slope)
+
+    starts = ends[crossing] - counts[crossing]
+    output[starts, 0] = x
+    output[starts, 1] = y
+
+    new_offsets = np.concatenate(([0], ends))[offsets]
+    return output, new_offsets
+
+
+def _clip_packed_chunk(vertices: np.ndarray, offsets: np.ndarray, win_values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    for edge, column in enumerate(WINDOW_EDGES):
+        if win_values.ndim == 1:
+            bound = np.broadcast_to(win_values[column], len(vertices))
+        else:
+            # Своё окно у каждого полигона - размножаем его край на вершины полигона
+            bound = np.repeat(win_values[:, column], np.diff(offsets))
+        vertices, offsets = _clip_stage(vertices, offsets, edge, bound)
+    return vertices, offsets
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        # fork из процесса с потоками (uvicorn, профайлер) может унаследовать захваченные блокировки
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        _process_pool = ProcessPoolExecutor(mp_context=context)
+    return _process_pool
+
+
+async def _run_in_pool(fn, chunks: list) -> list:
+    """Считает части в пуле процессов; цикл событий ждёт результаты, не блокируясь"""
+    pool = _get_process_pool()
+    return await asyncio.gather(*(asyncio.wrap_future(pool.submit(fn, *args)) for args in chunks))
+
+
+def _split_points(offsets: np.ndarray, parts: int) -> np.ndarray:
+    """Индексы элементов, делящие пакет на части с примерно равным числом вершин"""
+    targets = np.linspace(0, offsets[-1], parts + 1)[1:-1]
+    return np.unique(np.concatenate(([0], np.searchsorted(offsets, targets), [len(offsets) - 1])))
+
+
+async def clip_polygons(vertices: np.ndarray, offsets: np.ndarray, win_values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Отсекает пакет полигонов прямоугольным окном [xmin, ymin, xmax, ymax]
+    или, если win_values имеет форму (P, 4), каждый полигон своим окном.
+    Результат возвращается в том же упакованном виде, полигон i остаётся
+    под индексом i (полностью отсечённый полигон становится пустым).
+    """
+    vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 2)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    win_values = np.asarray(win_values, dtype=np.float64)
+
+    workers = os.cpu_count() or 1
+    if len(vertices) < PARALLEL_MIN_VERTICES or workers < 2 or len(offsets) < 3:
+        return _clip_packed_chunk(vertices, offsets, win_values)
+
+    # Делим пакет по границам полигонов на части с примерно равным числом вершин
+    cuts = _split_points(offsets, workers)
+
+    results = await _run_in_pool(_clip_packed_chunk, [
+        (vertices[offsets[a]:offsets[b]], offsets[a:b + 1] - offsets[a],
+         win_values if win_values.ndim == 1 else win_values[a:b])
+        for a, b in zip(cuts[:-1], cuts[1:])
+    ])
+
+    # Склеиваем части, сдвигая offsets каждой на число вершин перед ней
+    shift = np.cumsum([0] + [len(v) for v, _ in results[:-1]])
+    out_vertices = np.concatenate([v for v, _ in results])
+    out_offsets = np.concatenate([[0]] + [o[1:] + d for (_, o), d in zip(results, shift)])
+    return out_vertices, out_offsets
+
+
 def clip_polygon(subject_polygon: List[Point], win: Rect) -> List[Point]:
     """
     Отсекает полигон прямоугольным окном.
     Порядок обхода окна: Лево, Право, Низ, Верх
     """
+    if not subject_polygon:
+        return []
 
-    def inside(p: Point, edge: int) -> bool:
-        if edge == 0: return p.x >= win.xmin  # Left
-        if edge == 1: return p.x <= win.xmax  # Right
-        if edge == 2: return p.y >= win.ymin  # Bottom
-        if edge == 3: return p.y <= win.ymax  # Top
-        return False
-
-    def compute_intersection(p1: Point, p2: Point, edge: int) -> Point:
-        # Формула пересечения прямой (p1, p2) с краем окна
-        # y = y1 + slope * (x - x1)
-        # x = x1 + (1/slope) * (y - y1)
-
-        dx = p2.x - p1.x
-        dy = p2.y - p1.y
-        slope = dy / dx if dx != 0 else 0
-
-        if edge == 0:  # Left x = xmin
-            x = win.xmin
-            y = p1.y + slope * (x - p1.x)
-        elif edge == 1:  # Right x = xmax
-            x = win.xmax
-            y = p1.y + slope * (x - p1.x)
-        elif edge == 2:  # Bottom y = ymin
-            y = win.ymin
-            if dx == 0:
-                x = p1.x
-            else:
-                x = p1.x + (y - p1.y) / slope
-        elif edge == 3:  # Top y = ymax
-            y = win.ymax
-            if dx == 0:
-                x = p1.x
-            else:
-                x = p1.x + (y - p1.y) / slope
-        else:
-            x, y = 0, 0
+    vertices = np.array([(p.x, p.y) for p in subject_polygon])
+    offsets = np.array([0, len(vertices)])
+    clipped, _ = _clip_packed_chunk(vertices, offsets, np.array([win.xmin, win.ymin, win.xmax, win.ymax]))
+    return [Point(x=x, y=y) for x, y in clipped.tolist()]
+
+
+def segments_to_polygons(segments: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Собирает полигоны из последовательных отрезков: вершины - начала отрезков.
+    Цепочка разрывается там, где начало отрезка не совпадает с концом предыдущего.
+    Замкнутые цепочки становятся отдельными полигонами, а идущие подряд
+    незамкнутые, как и раньше, считаются одним общим контуром.
+    """
+    n = len(segments)
+    vertices = segments[:, :2]
+    if n == 0:
+        return vertices, np.zeros(1, dtype=np.int64)
+
+    breaks = np.any(segments[1:, :2] != segments[:-1, 2:], axis=1)
+    run_starts = np.concatenate(([0], np.flatnonzero(breaks) + 1))
+    run_ends = np.concatenate((run_starts[1:], [n]))
+    closed = np.all(segments[run_ends - 1, 2:] == segments[run_starts, :2], axis=1)
+
+    # Незамкнутая цепочка после незамкнутой продолжает тот же полигон
+    new_polygon = np.ones(len(run_starts), dtype=bool)
+    new_polygon[1:] = closed[1:] | closed[:-1]
+
+    offsets = np.concatenate((run_starts[new_polygon], [n])).astype(np.int64)
+    return vertices, offsets
+
+
+# --- Разбор входных данных ---
+
+# Размер блока при потоковом чтении загруженного файла
+CHUNK_SIZE = 1 << 20
+
+# Допустимые форматы файла: текст из задания или плоский массив чисел
+# [n, x1, y1, x2, y2, ..., xmin, ymin, xmax, ymax] в little-endian
+BINARY_DTYPES = {
+    "float32": np.dtype("<f4"),
+    "float64": np.dtype("<f8"),
+}
+
+
+def parse_floats(text: str) -> np.ndarray:
+    """Разбор чисел, разделённых пробельными символами, одним вызовом NumPy"""
+    # На строке из одних пробелов np.fromstring возвращает [-1.]
+    if not text or text.isspace():
+        return np.empty(0)
+
+    # Старые версии NumPy на мусорных данных только предупреждают и обрывают чтение
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", DeprecationWarning)
+        try:
+            return np.fromstring(text, dtype=np.float64, sep=" ")
+        except DeprecationWarning as e:
+            raise ValueError(str(e))
+
+
+def split_values(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Делит плоский массив [n, отрезки..., окно] на массив отрезков (n, 4) и окно (4,)"""
+    if values.size == 0:
+        raise ValueError("Пустые входные данные")
 
-        return Point(x=x, y=y)
+    n = int(values[0])
+    if n < 0 or values[0] != n:
+        raise ValueError(f"Некорректное число отрезков: {values[0]}")
 
-    output_list = subject_polygon
+    expected = 1 + 4 * n + 4
+    if values.size < expected:
+        raise ValueError(f"Ожидалось {expected} чисел, получено {values.size}")
 
-    # Для каждого из 4 краев окна
-    for edge in range(4):
-        input_list = output_list
-        output_list = []
+    segments = values[1:1 + 4 * n].astype(np.float64, copy=False).reshape(n, 4)
+    window = values[1 + 4 * n:expected].astype(np.float64, copy=False)
+    return segments, window
 
-        if not input_list:
+
+def parse_text(raw_data: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Разбор текстового формата из задания сразу в массив NumPy.
+    Переводы строк считаются обычными разделителями, поэтому
+    весь текст читается одним вызовом без промежуточных списков.
+    """
+    return split_values(parse_floats(raw_data))
+
+
+async def read_binary(file: UploadFile, dtype: np.dtype) -> np.ndarray:
+    """Потоковое чтение плоского бинарного массива блоками по CHUNK_SIZE"""
+    parts = []
+    rest = b""
+    while True:
+        chunk = await file.read(CHUNK_SIZE)
+        if not chunk:
             break
+        chunk = rest + chunk
+        usable = len(chunk) - len(chunk) % dtype.itemsize
+        rest = chunk[usable:]
+        parts.append(np.frombuffer(chunk, dtype=dtype, count=usable // dtype.itemsize))
+    if rest:
+        raise ValueError(f"Размер файла не кратен {dtype.itemsize} байтам")
+    return np.concatenate(parts) if parts else np.empty(0, dtype=dtype)
+
+
+async def parse_upload(file: UploadFile, data_format: str = "text") -> Tuple[np.ndarray, np.ndarray]:
+    """Потоковое чтение файла блоками по CHUNK_SIZE без загрузки текста целиком"""
+    parts = []
+
+    if data_format == "text":
+        tail = b""
+        while True:
+            chunk = await file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            chunk = tail + chunk
+            # Число могло разорваться на границе блока - откладываем хвост до следующего
+            cut = max(chunk.rfind(b" "), chunk.rfind(b"\n"), chunk.rfind(b"\t"), chunk.rfind(b"\r"))
+            if cut < 0:
+                tail = chunk
+                continue
+            tail = chunk[cut + 1:]
+            parts.append(parse_floats(chunk[:cut + 1].decode("ascii")))
+        if tail:
+            parts.append(parse_floats(tail.decode("ascii")))
+
+    elif data_format in BINARY_DTYPES:
+        parts.append(await read_binary(file, BINARY_DTYPES[data_format]))
+
+    else:
+        raise ValueError(f"Неизвестный формат: {data_format}")
+
+    values = np.concatenate(parts) if parts else np.empty(0)
+    return split_values(values)
+
+
+# --- Отсечение ---
+
+CLIP_MODES = ("lines", "polygon")
+
+
+async def clip_geometry(segments: np.ndarray, win_values: np.ndarray, mode: str) -> JSONResponse:
+    """
+    Отсекает разобранные отрезки окном и формирует ответ для клиента.
+    Ответ кодируется в JSON здесь же, чтобы это время вошло в этап serialize
+    """
+    window = Rect(xmin=win_values[0], ymin=win_values[1], xmax=win_values[2], ymax=win_values[3])
+
+    with stage("compute"):
+        if mode == "lines":
+            # Вариант 15 Ч.1: Алгоритм средней точки
+            clipped, _ = await midpoint_clip_lines(segments, win_values)
+        else:
+            # Отсечение полигонов
+            # Собираем вершины из последовательных отрезков, каждый замкнутый контур - отдельный полигон
+            # Примечание: обычно последняя точка сегмента N совпадает с первой точкой сегмента N+1
+            vertices, offsets = segments_to_polygons(segments)
+            clipped, clipped_offsets = await clip_polygons(vertices, offsets, win_values)
+
+    with stage("serialize"):
+        result_geometry = []
+        if mode == "lines":
+            for x1, y1, x2, y2 in clipped.tolist():
+                result_geometry.append([{"x": x1, "y": y1}, {"x": x2, "y": y2}])
+        else:
+            # Преобразуем результат в формат списка точек для JSON
+            points = [{"x": x, "y": y} for x, y in clipped.tolist()]
+            for a, b in zip(clipped_offsets[:-1].tolist(), clipped_offsets[1:].tolist()):
+                if b > a:
+                    result_geometry.append(points[a:b])
+
+        return JSONResponse({
+            "window": {"xmin": window.xmin, "ymin": window.ymin, "xmax": window.xmax, "ymax": window.ymax},
+            "original_lines": [
+                [{"x": x1, "y": y1}, {"x": x2, "y": y2}] for x1, y1, x2, y2 in segments.tolist()
+            ],
+            "result": result_geometry,
+            "mode": mode
+        })
+
+
+# --- Отсечение сеткой тайлов ---
 
-        S = input_list[-1]  # Последняя точка
+# Ограничения на размер сетки, число пар (объект, тайл) и вершин в них - под них выделяется память
+MAX_TILES = 1_000_000
+MAX_TILE_PAIRS = 4_000_000
+MAX_TILE_VERTICES = 8_000_000
+
+def tile_edges(win_values: np.ndarray, cols: int, rows: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Границы тайлов: окно из входных данных делится на cols x rows равных частей"""
+    xmin, ymin, xmax, ymax = win_values
+    return np.linspace(xmin, xmax, cols + 1), np.linspace(ymin, ymax, rows + 1)
+
+
+def bin_to_tiles(bboxes: np.ndarray, xs: np.ndarray, ys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Раскладывает объекты по тайлам, которые пересекает их ограничивающий прямоугольник
+    [xmin, ymin, xmax, ymax]. Возвращает пары (номер объекта, номер тайла),
+    упорядоченные по тайлам; их число равно числу пересечений, а не тайлы x объекты.
+    """
+    cols, rows = len(xs) - 1, len(ys) - 1
+
+    # Тайл c задевает прямоугольник, если xs[c] <= xmax и xs[c + 1] >= xmin (границы тайлов замкнуты)
+    col_lo = np.maximum(np.searchsorted(xs, bboxes[:, 0], side="left") - 1, 0)
+    col_hi = np.minimum(np.searchsorted(xs, bboxes[:, 2], side="right") - 1, cols - 1)
+    row_lo = np.maximum(np.searchsorted(ys, bboxes[:, 1], side="left") - 1, 0)
+    row_hi = np.minimum(np.searchsorted(ys, bboxes[:, 3], side="right") - 1, rows - 1)
+
+    n_cols = np.maximum(col_hi - col_lo + 1, 0)
+    n_rows = np.maximum(row_hi - row_lo + 1, 0)
+    counts = n_cols * n_rows
+    if counts.sum() > MAX_TILE_PAIRS:
+        raise ValueError(f"Слишком много пар объект-тайл: {counts.sum()}, допустимо {MAX_TILE_PAIRS}")
+
+    item = np.repeat(np.arange(len(bboxes)), counts)
+    local = np.arange(len(item)) - np.repeat(np.cumsum(counts) - counts, counts)
+    col = col_lo[item] + local % n_cols[item]
+    row = row_lo[item] + local // n_cols[item]
+    tile = row * cols + col
+
+    order = np.argsort(tile, kind="stable")
+    return item[order], tile[order]
+
+
+async def clip_tiles(segments: np.ndarray, win_values: np.ndarray, cols: int, rows: int, mode: str):
+    """
+    Отсекает весь набор геометрии сеткой тайлов за один проход.
+    Пары (объект, тайл) отсекаются одним векторным вызовом, каждая со своим окном.
+    Возвращает итератор результатов по тайлам, тайлы без видимой геометрии пропускаются.
+    """
+    xs, ys = tile_edges(win_values, cols, rows)
+
+    if mode == "lines":
+        bboxes = np.stack([
+            np.minimum(segments[:, 0], segments[:, 2]), np.minimum(segments[:, 1], segments[:, 3]),
+            np.maximum(segments[:, 0], segments[:, 2]), np.maximum(segments[:, 1], segments[:, 3]),
+        ], axis=1)
+    else:
+        vertices, offsets = segments_to_polygons(segments)
+        if len(vertices):
+            starts = offsets[:-1]
+            bboxes = np.concatenate([np.minimum.reduceat(vertices, starts), np.maximum.reduceat(vertices, starts)], axis=1)
+        else:
+            bboxes = np.empty((0, 4))
 
-        for E in input_list:
-            if inside(E, edge):
-                if not inside(S, edge):
-                    output_list.append(compute_intersection(S, E, edge))
-                output_list.append(E)
-            elif inside(S, edge):
-                output_list.append(compute_intersection(S, E, edge))
-            S = E
+    item, tile = bin_to_tiles(bboxes, xs, ys)
+    col, row = tile % cols, tile // cols
+    windows = np.stack([xs[col], ys[row], xs[col + 1], ys[row + 1]], axis=1)
 
-    return output_list
+    if mode == "lines":
+        clipped, pair = await midpoint_clip_lines(segments[item], windows)
+        bounds = np.arange(len(pair) + 1)
+    else:
+        # Собираем вершины полигонов для каждой пары в новый упакованный массив
+        lengths = np.diff(offsets)[item]
+        pair_offsets = np.concatenate(([0], np.cumsum(lengths)))
+        if pair_offsets[-1] > MAX_TILE_VERTICES:
+            raise ValueError(f"Слишком много вершин в тайлах: {pair_offsets[-1]}, допустимо {MAX_TILE_VERTICES}")
+        gather = np.repeat(offsets[:-1][item] - pair_offsets[:-1], lengths) + np.arange(pair_offsets[-1])
+        clipped, clipped_offsets = await clip_polygons(vertices[gather], pair_offsets, windows)
+        pair = np.flatnonzero(np.diff(clipped_offsets) > 0)
+        bounds = clipped_offsets
+
+    # Пары упорядочены по тайлам, поэтому результаты каждого тайла идут подряд.
+    # Отсечение уже выполнено, лениво формируются только ответы по тайлам
+    groups = np.flatnonzero(np.diff(tile[pair])) + 1
+    group_bounds = list(zip(np.concatenate(([0], groups)).tolist(), np.concatenate((groups, [len(pair)])).tolist()))
+
+    def tile_results():
+        for a, b in group_bounds:
+            if a == b:
+                continue
+            first = pair[a]
+            if mode == "lines":
+                result = [[{"x": x1, "y": y1}, {"x": x2, "y": y2}] for x1, y1, x2, y2 in clipped[a:b].tolist()]
+            else:
+                result = [
+                    [{"x": x, "y": y} for x, y in clipped[bounds[p]:bounds[p + 1]].tolist()]
+                    for p in pair[a:b].tolist()
+                ]
+            xmin, ymin, xmax, ymax = windows[first].tolist()
+            yield {
+                "tile": {"col": int(col[first]), "row": int(row[first])},
+                "window": {"xmin": xmin, "ymin": ymin, "xmax": xmax, "ymax": ymax},
+                "source": item[pair[a:b]].tolist(),
+                "result": result,
+                "mode": mode
+            }
+
+    return tile_results()
 
 
 # --- Маршруты API ---
@@ -164,67 +635,107 @@ async def process_data(
         mode: str = Form(...)  # "lines" или "polygon"
 ):
     try:
-        lines = raw_data.strip().split('\n')
-        lines = [L.strip() for L in lines if L.strip()]
-
-        # Парсинг формата из задания
-        # Строка 1: n
-        n = int(lines[0])
-        segments_data = []
-
-        # Читаем n строк с координатами
-        for i in range(1, n + 1):
-            parts = list(map(float, lines[i].split()))
-            segments_data.append(Segment(
-                p1=Point(x=parts[0], y=parts[1]),
-                p2=Point(x=parts[2], y=parts[3])
-            ))
-
-        # Последняя строка: окно
-        win_parts = list(map(float, lines[n + 1].split()))
-        window = Rect(xmin=win_parts[0], ymin=win_parts[1], xmax=win_parts[2], ymax=win_parts[3])
+        set_labels(algorithm=known_label(mode, CLIP_MODES))
+        # Парсинг формата из задания:
+        # n, затем n строк "x1 y1 x2 y2", последняя строка - окно
+        with stage("parse"):
+            segments, window = parse_text(raw_data)
+        return await clip_geometry(segments, window, mode)
 
-        result_geometry = []
+    except Exception as e:
+        return {"error": str(e)}
 
-        if mode == "lines":
-            # Вариант 15 Ч.1: Алгоритм средней точки
-            for seg in segments_data:
-                clipped = midpoint_clip_line(seg.p1, seg.p2, window)
-                if clipped:
-                    result_geometry.append([
-                        {"x": clipped.p1.x, "y": clipped.p1.y},
-                        {"x": clipped.p2.x, "y": clipped.p2.y}
-                    ])
-        else:
-            # Отсечение полигона
-            # Собираем точки из сегментов в один список вершин
-            # Предполагаем, что входные сегменты идут последовательно и образуют замкнутый контур
-            poly_points = []
-            for seg in segments_data:
-                poly_points.append(seg.p1)
-            # Примечание: обычно последняя точка сегмента N совпадает с первой точкой сегмента N+1
 
-            clipped_poly = clip_polygon(poly_points, window)
+@app.post("/process_file")
+async def process_file(
+        file: UploadFile = File(...),
+        mode: str = Form(...),  # "lines" или "polygon"
+        data_format: str = Form("text")  # "text", "float32" или "float64"
+):
+    try:
+        set_labels(algorithm=known_label(mode, CLIP_MODES))
+        with stage("parse"):
+            segments, window = await parse_upload(file, data_format)
+        return await clip_geometry(segments, window, mode)
 
-            # Преобразуем результат в формат списка точек для JSON
-            res_points = [{"x": p.x, "y": p.y} for p in clipped_poly]
-            if res_points:
-                result_geometry.append(res_points)
+    except Exception as e:
+        return {"error": str(e)}
 
-        return {
-            "window": {"xmin": window.xmin, "ymin": window.ymin, "xmax": window.xmax, "ymax": window.ymax},
-            "original_lines": [
-                [{"x": s.p1.x, "y": s.p1.y}, {"x": s.p2.x, "y": s.p2.y}] for s in segments_data
-            ],
-            "result": result_geometry,
-            "mode": mode
-        }
+
+@app.post("/clip_polygons")
+async def clip_polygons_packed(
+        vertices: UploadFile = File(...),  # пары x y подряд, float32 или float64
+        offsets: UploadFile = File(...),  # int64, P + 1 границ полигонов
+        xmin: float = Form(...),
+        ymin: float = Form(...),
+        xmax: float = Form(...),
+        ymax: float = Form(...),
+        data_format: str = Form("float64")
+):
+    """Пакетное отсечение полигонов, ответ - архив .npz с массивами vertices и offsets"""
+    try:
+        set_labels(algorithm="polygon")
+        if data_format not in BINARY_DTYPES:
+            raise ValueError(f"Неизвестный формат: {data_format}")
+        with stage("parse"):
+            packed_vertices = await read_binary(vertices, BINARY_DTYPES[data_format])
+            packed_offsets = await read_binary(offsets, np.dtype("<i8"))
+
+        if packed_vertices.size % 2:
+            raise ValueError("Нечётное число координат")
+        if (packed_offsets.size == 0 or packed_offsets[0] != 0 or packed_offsets[-1] != packed_vertices.size // 2
+                or np.any(np.diff(packed_offsets) < 0)):
+            raise ValueError("Некорректный массив offsets")
+
+        with stage("compute"):
+            clipped, clipped_offsets = await clip_polygons(packed_vertices, packed_offsets, np.array([xmin, ymin, xmax, ymax]))
+
+        with stage("serialize"):
+            buffer = io.BytesIO()
+            np.savez(buffer, vertices=clipped, offsets=clipped_offsets)
+        return Response(content=buffer.getvalue(), media_type="application/octet-stream")
+
+    except Exception as e:
+        return {"error": str(e)}
+
+
+@app.post("/process_tiles")
+async def process_tiles(
+        mode: str = Form(...),  # "lines" или "polygon"
+        cols: int = Form(...),
+        rows: int = Form(...),
+        raw_data: Optional[str] = Form(None),
+        file: Optional[UploadFile] = File(None),
+        data_format: str = Form("text")
+):
+    """
+    Отсечение сеткой тайлов: окно из входных данных делится на cols x rows тайлов.
+    Ответ - поток NDJSON, по одной строке на каждый тайл с видимой геометрией.
+    """
+    try:
+        set_labels(algorithm=known_label(mode, CLIP_MODES))
+        if cols < 1 or rows < 1:
+            raise ValueError("Размер сетки должен быть положительным")
+        if cols * rows > MAX_TILES:
+            raise ValueError(f"Слишком много тайлов: {cols * rows}, допустимо {MAX_TILES}")
+        with stage("parse"):
+            if file is not None:
+                segments, window = await parse_upload(file, data_format)
+            elif raw_data is not None:
+                segments, window = parse_text(raw_data)
+            else:
+                raise ValueError("Нет входных данных")
+
+        with stage("compute"):
+            tiles = await clip_tiles(segments, window, cols, rows, mode)
+        return StreamingResponse((json.dumps(t) + "\n" for t in tiles), media_type="application/x-ndjson")
 
     except Exception as e:
         return {"error": str(e)}
 
 
 if __name__ == "__main__":
+    # python -m lab_4.main из корня репозитория или python main.py из каталога lab_4
     import uvicorn
 
     uvicorn.run(app, host="127.0.0.1", port=8000)
@@ -0,0 +1,381 @@
+"""
+Нагрузочное тестирование эндпоинтов всех лабораторных.
+
+Примеры:
+    python loadtest.py --lab lab_2 --concurrency 8 --requests 200 --image-size 1024x768 --upload-share 0.2
+    python loadtest.py --lab all --server uvicorn --baseline baselines.json
+    python loadtest.py --lab lab_4 --segments 5000 --baseline baselines.json --save-baseline
+
+Приложение запускается либо в этом же процессе (--server inprocess, запросы идут через
+ASGI без сети), либо отдельным процессом uvicorn (--server uvicorn, настоящий HTTP).
+Отчёт: пропускная способность, задержки p50/p95/p99 и память сервера (RSS) во времени.
+С --baseline результаты сравниваются с сохранёнными, при регрессии больше --tolerance
+процентов код выхода 1; --save-baseline записывает текущие результаты как новые базовые.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+import numpy as np
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Модуль приложения каждой лабораторной
+LAB_MODULES = {
+    "lab_1": "app",
+    "lab_2": "main",
+    "lab_3": "main",
+    "lab_4": "main",
+}
+
+RSS_INTERVAL = 0.5
+RSS_PRINT_POINTS = 20
+
+
+# --- Генераторы нагрузки ---
+
+def random_color_request(rng):
+    """Случайный цвет в одной из моделей для /convert"""
+    model = rng.choice(["rgb", "cmyk", "hls"])
+    if model == "rgb":
+        values = {"r": rng.randint(0, 255), "g": rng.randint(0, 255), "b": rng.randint(0, 255)}
+    elif model == "cmyk":
+        values = {k: round(rng.random(), 3) for k in "cmyk"}
+    else:
+        values = {"h": rng.randint(0, 360), "l": round(rng.random(), 3), "s": round(rng.random(), 3)}
+    return {"method": "POST", "url": "/convert", "data": {"source_model": model, "values": json.dumps(values)}}
+
+
+def synthetic_image(width, height, seed=0):
+    """PNG заданного размера: градиент с шумом, чтобы фильтрам было что обрабатывать"""
+    import cv2
+
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 // max(width - 1, 1), y * 255 // max(height - 1, 1), (x + y) % 256], axis=2)
+    noise = rng.integers(-40, 40, (height, width, 3))
+    img = np.clip(base + noise, 0, 255).astype(np.uint8)
+    _, buffer = cv2.imencode(".png", img)
+    return buffer.tobytes()
+
+
+def random_filter_request(rng):
+    """Случайный метод и параметры для /api/process"""
+    return {"method": "POST", "url": "/api/process", "data": {
+        "method": rng.choice(["median", "adaptive_mean", "adaptive_gaussian"]),
+        "kernel_size": rng.randrange(3, 22, 2),
+        "block_size": rng.randrange(3, 256, 2),
+        "c_val": rng.randint(0, 50),
+    }}
+
+
+def random_draw_request(rng, extent=200):
+    """Случайный отрезок или окружность для /calculate"""
+    algorithm = rng.choice(["step", "dda", "bresenham_line", "bresenham_circle", "wu", "castle_pitteway"])
+    payload = {"algorithm": algorithm, "x1": rng.randint(-extent, extent), "y1": rng.randint(-extent, extent)}
+    if algorithm == "bresenham_circle":
+        payload["radius"] = rng.randint(1, extent)
+    else:
+        payload["x2"] = rng.randint(-extent, extent)
+        payload["y2"] = rng.randint(-extent, extent)
+    return {"method": "POST", "url": "/calculate", "json": payload}
+
+
+def clip_input(rng, segments, extent=1000.0):
+    """Входной текст для /process: n, n случайных отрезков и окно в центре области"""
+    lines = [str(segments)]
+    for _ in range(segments):
+        lines.append(" ".join(f"{rng.uniform(0, extent):.3f}" for _ in range(4)))
+    lines.append(f"{extent / 4} {extent / 4} {extent * 3 / 4} {extent * 3 / 4}")
+    return "\n".join(lines)
+
+
+def lab_scenario(lab, args):
+    """Подготовка (запросы до замеров) и генератор запросов для лабораторной"""
+    rng = random.Random(args.seed)
+
+    if lab == "lab_1":
+        return [], lambda: random_color_request(rng)
+
+    if lab == "lab_2":
+        width, height = args.image_size
+        upload = {"method": "POST", "url": "/upload",
+                  "files": {"file": ("image.png", synthetic_image(width, height, args.seed), "image/png")}}
+
+        # Загрузка идёт и в замер: декодирование, кодирование превью и сброс кэша порогов
+        def make_request():
+            return upload if rng.random() < args.upload_share else random_filter_request(rng)
+
+        return [upload], make_request
+
+    if lab == "lab_3":
+        return [], lambda: random_draw_request(rng)
+
+    if lab == "lab_4":
+        # Набор входов готовится заранее, чтобы генерация текста не попадала в замер
+        inputs = [clip_input(rng, args.segments) for _ in range(8)]
+        return [], lambda: {"method": "POST", "url": "/process", "data": {
+            "raw_data": rng.choice(inputs), "mode": rng.choice(["lines", "polygon"])}}
+
+    raise ValueError(f"Unknown lab: {lab}")
+
+
+def scenario_key(lab, args):
+    """Ключ для базовых результатов: одинаковые параметры нагрузки - одинаковый ключ"""
+    key = f"{lab}:{args.server}:c{args.concurrency}"
+    if lab == "lab_2":
+        key += f":{args.image_size[0]}x{args.image_size[1]}:u{args.upload_share:g}"
+    if lab == "lab_4":
+        key += f":n{args.segments}"
+    return key
+
+
+# --- Запуск приложения ---
+
+def load_app(lab):
+    """Импорт приложения лабораторной как модуля из корня репозитория"""
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    return importlib.import_module(f"{lab}.{LAB_MODULES[lab]}").app
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def start_uvicorn(lab):
+    """Отдельный процесс uvicorn; возвращает процесс и базовый URL после готовности"""
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", f"{lab}.{LAB_MODULES[lab]}:app", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        for _ in range(100):
+            if process.poll() is not None:
+                raise RuntimeError(f"uvicorn exited with code {process.returncode}")
+            try:
+                # /metrics есть у всех лабораторных и не зависит от шаблонов
+                await client.get("/metrics")
+                return process, base_url
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("uvicorn did not start")
+
+
+def rss_bytes(pid):
+    """Текущий RSS процесса из /proc; вне Linux - пиковый RSS своего процесса"""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+# --- Нагрузка и отчёт ---
+
+def response_failed(response):
+    """Ошибка по статусу или по телу: lab_4 отвечает 200 с {"error": ...}"""
+    if response.status_code >= 400:
+        return True
+    if not response.headers.get("content-type", "").startswith("application/json"):
+        return False
+    try:
+        body = response.json()
+    except ValueError:
+        return True
+    return isinstance(body, dict) and "error" in body
+
+
+async def run_load(client, make_request, total, concurrency, pid):
+    latencies = []
+    errors = 0
+    rss = []
+    issued = 0
+    start = time.perf_counter()
+
+    async def worker():
+        nonlocal issued, errors
+        while issued < total:
+            issued += 1
+            request = make_request()
+            t = time.perf_counter()
+            try:
+                response = await client.request(**request)
+            except httpx.HTTPError:
+                response = None
+            latencies.append(time.perf_counter() - t)
+            errors += response is None or response_failed(response)
+
+    # Память снимается из отдельного потока: в режиме inprocess обработчики
+    # занимают цикл событий, и задача в нём не успевала бы сработать
+    done = threading.Event()
+
+    def sample_rss():
+        while not done.is_set():
+            rss.append((time.perf_counter() - start, rss_bytes(pid)))
+            done.wait(RSS_INTERVAL)
+
+    sampler = threading.Thread(target=sample_rss, daemon=True)
+    sampler.start()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    done.set()
+    sampler.join()
+    rss.append((elapsed, rss_bytes(pid)))
+
+    latencies_ms = np.array(latencies) * 1000
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99]) if len(latencies_ms) else (0, 0, 0)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "elapsed_s": elapsed,
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99),
+        "max_ms": float(latencies_ms.max()) if len(latencies_ms) else 0.0,
+        "rss_start_mb": rss[0][1] / 2 ** 20,
+        "rss_peak_mb": max(r for _, r in rss) / 2 ** 20,
+        "rss_end_mb": rss[-1][1] / 2 ** 20,
+        "rss_timeline": [(round(t, 2), round(r / 2 ** 20, 1)) for t, r in rss],
+    }
+
+
+async def run_lab(lab, args):
+    setup, make_request = lab_scenario(lab, args)
+
+    process = None
+    if args.server == "uvicorn":
+        process, base_url = await start_uvicorn(lab)
+        client = httpx.AsyncClient(base_url=base_url, timeout=args.timeout)
+        pid = process.pid
+    else:
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=load_app(lab)),
+                                   base_url="http://loadtest", timeout=args.timeout)
+        pid = os.getpid()
+
+    try:
+        for request in setup:
+            response = await client.request(**request)
+            response.raise_for_status()
+        # Прогрев: первые запросы заполняют кэши и не идут в статистику
+        for _ in range(min(args.warmup, args.requests)):
+            await client.request(**make_request())
+        return await run_load(client, make_request, args.requests, args.concurrency, pid)
+    finally:
+        await client.aclose()
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+
+def print_report(key, result, baseline):
+    print(f"\n== {key}")
+    print(f"requests {result['requests']}  errors {result['errors']}  "
+          f"throughput {result['throughput_rps']:.1f} req/s")
+    print(f"latency ms  p50 {result['p50_ms']:.2f}  p95 {result['p95_ms']:.2f}  "
+          f"p99 {result['p99_ms']:.2f}  max {result['max_ms']:.2f}")
+    print(f"RSS MB  start {result['rss_start_mb']:.1f}  peak {result['rss_peak_mb']:.1f}  end {result['rss_end_mb']:.1f}")
+    timeline = result["rss_timeline"]
+    step = max(1, len(timeline) // RSS_PRINT_POINTS)
+    print("RSS timeline " + " ".join(f"{t}s:{r}" for t, r in timeline[::step]))
+
+    if baseline is None:
+        return []
+
+    # Для пропускной способности хуже - меньше, для задержек и памяти - больше
+    regressions = []
+    for metric, higher_is_better in (("throughput_rps", True), ("p50_ms", False), ("p95_ms", False),
+                                     ("p99_ms", False), ("rss_peak_mb", False)):
+        old, new = baseline.get(metric), result[metric]
+        if not old:
+            continue
+        change = (new - old) / old * 100
+        worse = -change if higher_is_better else change
+        print(f"  {metric:15s} {old:10.2f} -> {new:10.2f}  ({change:+.1f}%)")
+        regressions.append((metric, worse))
+    return regressions
+
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for the lab endpoints")
+    parser.add_argument("--lab", default="all", choices=["all", *LAB_MODULES])
+    parser.add_argument("--server", default="inprocess", choices=["inprocess", "uvicorn"])
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--image-size", type=parse_size, default=(640, 480), help="WIDTHxHEIGHT for lab_2")
+    parser.add_argument("--upload-share", type=float, default=0.1, help="share of /upload requests for lab_2")
+    parser.add_argument("--segments", type=int, default=1000, help="segments per clip request for lab_4")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", help="JSON file with stored results")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results in --baseline")
+    parser.add_argument("--tolerance", type=float, default=10.0, help="allowed regression, percent")
+    args = parser.parse_args()
+
+    baselines = {}
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+
+    labs = list(LAB_MODULES) if args.lab == "all" else [args.lab]
+    failed = []
+    broken = []
+    for lab in labs:
+        key = scenario_key(lab, args)
+        result = asyncio.run(run_lab(lab, args))
+        # Прогон с ошибками не годится ни в сравнение, ни в базовые результаты
+        baseline = None if result["errors"] else baselines.get(key)
+        for metric, worse in print_report(key, result, baseline):
+            if worse > args.tolerance:
+                failed.append(f"{key} {metric} {worse:+.1f}%")
+        if result["errors"]:
+            broken.append(f"{key} {result['errors']} of {result['requests']} requests failed")
+        elif args.save_baseline:
+            baselines[key] = {k: v for k, v in result.items() if k != "rss_timeline"}
+
+    if args.save_baseline and baseline_path:
+        with open(baseline_path, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f"\nBaseline saved to {baseline_path}")
+
+    if broken:
+        print("\nFailed requests:")
+        for line in broken:
+            print("  " + line)
+    if failed and not args.save_baseline:
+        print("\nRegressions above tolerance:")
+        for line in failed:
+            print("  " + line)
+    if broken or (failed and not args.save_baseline):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()